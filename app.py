@@ -1,21 +1,117 @@
 import os
+import json
+import time
+import asyncio
+import functools
+import hashlib
+import sqlite3
+import queue
+import threading
+import contextlib
 import openai
+import tiktoken
 import secrets
 import base64
-from flask import Flask, render_template, redirect, url_for, flash, request
+from collections import OrderedDict, defaultdict
+import uvicorn
+from quart import Quart, render_template, redirect, url_for, flash, request
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
-app = Flask(__name__)
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the optional semantic cache.
+    np = None
+
+app = Quart(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'default_key_for_dev') # Replace with a secure secret key
 
 # Set your Gmail API scopes and OpenAI API key.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# Gmail accepts up to 100 calls per batch, but recommends staying at or below 50.
+GMAIL_BATCH_SIZE = 50
+# Messages listed per page when streaming unread mail into classification.
+LIST_PAGE_SIZE = 100
+# Cap on new messages classified by one web request; later runs pick up the rest.
+RUN_MAX_MESSAGES = 500
+# Number of example subjects listed in the flashed run summary (kept small to fit the session cookie).
+SUMMARY_SUBJECTS = 5
+# Partial response for message listings: only the Subject header and the snippet are used.
+MESSAGE_DETAIL_FIELDS = 'snippet,payload/headers'
+# Gmail API responses worth retrying with exponential back-off.
+RETRYABLE_STATUSES = {429, 500, 502, 503}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+CLASSIFY_MODEL = "gpt-4o-mini"
+CATEGORIES = ('Work', 'Personal', 'Promotions', 'Social', 'Updates')
+# Maximum number of OpenAI classification requests in flight at once.
+CLASSIFY_CONCURRENCY = 10
+# Gmail's batchModify accepts at most 1000 message IDs per call.
+GMAIL_MODIFY_BATCH_SIZE = 1000
+# Polling interval bounds (seconds) while waiting on an OpenAI batch job.
+BATCH_POLL_INITIAL = 10
+BATCH_POLL_MAX = 600
+# The Batch API accepts at most 50,000 requests and 200 MB per input file.
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+# Classification cache: exact matches persist in SQLite; the semantic tier is opt-in
+# (SEMANTIC_CACHE=1) since it spends an embeddings request per page of uncached emails.
+CLASSIFY_CACHE_PATH = 'classify_cache.db'
+CLASSIFY_CACHE_MAX_ENTRIES = 10000
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE') == '1' and np is not None
+SEMANTIC_CACHE_THRESHOLD = 0.85
+EMBEDDING_MODEL = "text-embedding-3-small"
+# The embeddings endpoint accepts up to 2048 inputs per request.
+EMBEDDING_BATCH_SIZE = 2048
+# Messages that were already labeled are recorded here, per custom prompt, and skipped on later runs.
+PROCESSED_DB_PATH = 'processed_messages.db'
+# Stays below SQLite's default limit of 999 bound parameters per statement.
+SQLITE_MAX_VARIABLES = 500
 #openai.api_key = 'Enter key'  Replace with your actual OpenAI API key
 
 
+def is_quota_error(exc):
+    """
+    Returns True if a Gmail API error is caused by rate limiting or a transient
+    server failure, i.e. the request is worth retrying.
+    """
+    if not isinstance(exc, HttpError):
+        return False
+    status = int(exc.resp.status)
+    if status in RETRYABLE_STATUSES:
+        return True
+    # 403 is also used for permission errors, so only retry the rate-limit reasons.
+    content = exc.content or b''
+    return status == 403 and any(reason.encode() in content for reason in RATE_LIMIT_REASONS)
+
+# Retries Gmail API calls on quota errors, sleeping min(2**n + jitter, 64) seconds.
+retry_google = retry(
+    retry=retry_if_exception(is_quota_error),
+    wait=wait_exponential_jitter(initial=1, max=64),
+    stop=stop_after_attempt(7),
+    reraise=True
+)
+
+@retry_google
+def execute_request(api_request):
+    """
+    Executes a single Gmail API request, retrying on quota errors.
+    """
+    return api_request.execute()
+
+def save_credentials(creds):
+    """
+    Writes refreshed credentials to token.json atomically, so a concurrent reader
+    never sees a partially written file. Each thread writes its own temporary file.
+    """
+    tmp_path = f'token.json.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(tmp_path, 'token.json')
+
 def gmail_authenticate():
     """
     Authenticates with the Gmail API and returns a service object.
@@ -29,93 +125,575 @@ def gmail_authenticate():
         else:
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    service = build('gmail', 'v1', credentials=creds)
+        save_credentials(creds)
+    service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
     return service
 
-def classify_email(subject, snippet, custom_prompt=None):
+# Authenticated Gmail services reused across requests. httplib2 is not thread-safe,
+# so each request checks out a service of its own and returns it when done.
+_idle_services = queue.SimpleQueue()
+
+@contextlib.asynccontextmanager
+async def gmail_service():
     """
-    Uses OpenAI to classify an email based on its subject and snippet.
+    Checks out an authenticated Gmail service for the duration of a request.
+    A new service is only built when none is idle or its credentials are no longer valid.
+    """
+    try:
+        service = _idle_services.get_nowait()
+    except queue.Empty:
+        service = None
+    if service is None or not service._http.credentials.valid:
+        service = await asyncio.to_thread(gmail_authenticate)
+    try:
+        yield service
+    finally:
+        _idle_services.put(service)
+
+async def run_gmail_call(func, *args):
+    """
+    Runs a blocking Gmail call in a worker thread. If the caller is cancelled, it still
+    waits for the thread to finish before propagating, so a service is never returned
+    to the pool while a thread is using it.
+    """
+    call = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(call)
+    except asyncio.CancelledError:
+        await asyncio.wait({call})
+        raise
+
+def build_classification_prompt(subject, snippet, custom_prompt=None):
+    """
+    Builds the classification prompt for an email.
     If a custom prompt is provided by the user, it is used to drive the classification.
     Otherwise, a default prompt is used.
     """
     if custom_prompt:
-        prompt = f"{custom_prompt}\n\nSubject: {subject}\nSnippet: {snippet}\n\nCategory:"
-    else:
-        prompt = (
-            "Classify the following email into one of these categories: Work, Personal, "
-            "Promotions, Social, or Updates. Please strictly choose one of the categories.\n\n"
-            f"Subject: {subject}\nSnippet: {snippet}\n\nCategory:"
-        )
+        return f"{custom_prompt}\n\nSubject: {subject}\nSnippet: {snippet}\n\nCategory:"
+    return (
+        "Classify the following email into one of these categories: Work, Personal, "
+        "Promotions, Social, or Updates. Please strictly choose one of the categories.\n\n"
+        f"Subject: {subject}\nSnippet: {snippet}\n\nCategory:"
+    )
+
+@functools.lru_cache(maxsize=None)
+def category_tokens():
+    """
+    Returns {token ID: category} mapping the first token of each category name.
+    The classifier is restricted to these tokens, so a single output token identifies the category.
+    """
+    encoding = tiktoken.encoding_for_model(CLASSIFY_MODEL)
+    return {encoding.encode(category)[0]: category for category in CATEGORIES}
+
+def completion_params(prompt):
+    """
+    Returns the OpenAI request parameters used for every classification, shared by
+    the real-time and Batch API paths. Output is limited to one token, biased towards
+    the category tokens.
+    """
+    return {
+        'model': CLASSIFY_MODEL,
+        'messages': [{'role': 'user', 'content': prompt}],
+        'max_tokens': 1,
+        'temperature': 0.0,
+        'logit_bias': {str(token): 100 for token in category_tokens()}
+    }
+
+def parse_category(text):
+    """
+    Maps the single output token back onto its category, or None if it is not a
+    category token, so the message is left unlabeled and retried on a later run.
+    """
+    tokens = tiktoken.encoding_for_model(CLASSIFY_MODEL).encode(text.strip())
+    if not tokens:
+        return None
+    return category_tokens().get(tokens[0])
+
+class ClassificationCache:
+    """
+    Two-tier cache of email classifications.
+    The exact tier is keyed on the SHA-1 of the model and prompt and persisted in SQLite,
+    so changing CLASSIFY_MODEL does not reuse classifications made by the previous model.
+    The semantic tier keeps embeddings in memory and reuses the category of a previous
+    email with the same custom prompt whose cosine similarity exceeds SEMANTIC_CACHE_THRESHOLD.
+    Each tier holds at most max_entries, evicting its least frequently used entries; the
+    semantic tier first drops whole custom prompts, least recently used first.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._db = None
+        self._lock = threading.Lock()
+        # custom_prompt -> [matrix of unit embeddings, categories, hit counts], least recently used first
+        self._semantic = OrderedDict()
+        # Separate from _lock, so a semantic lookup never waits on a SQLite transaction.
+        self._semantic_lock = threading.Lock()
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS classify_cache ("
+                "prompt_hash TEXT PRIMARY KEY, category TEXT NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+        return self._db
+
+    @staticmethod
+    def _prompt_hash(prompt):
+        return hashlib.sha1(f"{CLASSIFY_MODEL}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def get_many(self, prompts):
+        """
+        Returns the cached category (or None) for each prompt, using one lookup
+        transaction for the whole list.
+        """
+        hashes = [self._prompt_hash(prompt) for prompt in prompts]
+        found = {}
+        with self._lock:
+            db = self._connection()
+            with db:
+                for start in range(0, len(hashes), SQLITE_MAX_VARIABLES):
+                    chunk = hashes[start:start + SQLITE_MAX_VARIABLES]
+                    placeholders = ", ".join("?" * len(chunk))
+                    found.update(db.execute(
+                        f"SELECT prompt_hash, category FROM classify_cache WHERE prompt_hash IN ({placeholders})",
+                        chunk
+                    ))
+                db.executemany(
+                    "UPDATE classify_cache SET hits = hits + 1 WHERE prompt_hash = ?",
+                    [(prompt_hash,) for prompt_hash in hashes if prompt_hash in found]
+                )
+        return [found.get(prompt_hash) for prompt_hash in hashes]
+
+    def put_many(self, entries):
+        """
+        Stores (prompt, category) pairs in one write transaction, keeping the hit count of
+        existing entries and evicting the least frequently used ones only when over capacity.
+        """
+        rows = [(self._prompt_hash(prompt), category) for prompt, category in entries]
+        with self._lock:
+            db = self._connection()
+            with db:
+                # Rows inserted below get higher rowids; they are exempt from this round's eviction.
+                last_rowid = db.execute("SELECT COALESCE(MAX(rowid), 0) FROM classify_cache").fetchone()[0]
+                db.executemany(
+                    "INSERT INTO classify_cache (prompt_hash, category) VALUES (?, ?) "
+                    "ON CONFLICT(prompt_hash) DO UPDATE SET category = excluded.category",
+                    rows
+                )
+                excess = db.execute("SELECT COUNT(*) FROM classify_cache").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    db.execute(
+                        "DELETE FROM classify_cache WHERE prompt_hash IN ("
+                        "SELECT prompt_hash FROM classify_cache WHERE rowid <= ? ORDER BY hits, rowid LIMIT ?)",
+                        (last_rowid, excess)
+                    )
+
+    def get_similar(self, custom_prompt, vectors):
+        """
+        Returns, for each row of vectors, the category of the most similar cached email,
+        or None if none is close enough. All rows are compared with a single matrix product.
+        """
+        with self._semantic_lock:
+            entry = self._semantic.get(custom_prompt)
+            if entry is None:
+                return [None] * len(vectors)
+            self._semantic.move_to_end(custom_prompt)
+            cached, categories, hits = entry
+            similarities = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)) @ cached.T
+            results = []
+            for row, best in enumerate(similarities.argmax(axis=1)):
+                if similarities[row, best] > SEMANTIC_CACHE_THRESHOLD:
+                    hits[best] += 1
+                    results.append(categories[best])
+                else:
+                    results.append(None)
+            return results
+
+    def put_similar_many(self, custom_prompt, vectors, categories):
+        """
+        Adds the rows of vectors with their categories to the semantic tier with a single
+        concatenation. Beyond max_entries rows in total, the entries of other custom prompts
+        are dropped first, then the least frequently used entries of this one.
+        """
+        vectors = vectors[-self.max_entries:]
+        categories = list(categories)[-self.max_entries:]
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        with self._semantic_lock:
+            entry = self._semantic.pop(custom_prompt, None)
+            total = sum(len(other[1]) for other in self._semantic.values())
+            total += len(categories) + (len(entry[1]) if entry is not None else 0)
+            while total > self.max_entries and self._semantic:
+                total -= len(self._semantic.popitem(last=False)[1][1])
+            if entry is None:
+                self._semantic[custom_prompt] = [vectors, categories, [0] * len(categories)]
+                return
+            cached, cached_categories, hits = entry
+            excess = len(cached_categories) + len(categories) - self.max_entries
+            if excess > 0:
+                keep = np.sort(np.argsort(hits, kind='stable')[excess:])
+                cached = cached[keep]
+                cached_categories = [cached_categories[index] for index in keep]
+                hits = [hits[index] for index in keep]
+            self._semantic[custom_prompt] = [
+                np.concatenate([cached, vectors]), cached_categories + categories, hits + [0] * len(categories)
+            ]
+
+classification_cache = ClassificationCache(CLASSIFY_CACHE_PATH, CLASSIFY_CACHE_MAX_ENTRIES)
+
+class ProcessedMessages:
+    """
+    Records the Gmail messages that have already been labeled, as
+    (id, prompt hash) -> label_id in SQLite, so later runs with the same custom prompt
+    only classify new messages. A different prompt classifies every message again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS processed_messages ("
+                "id TEXT NOT NULL, prompt_hash TEXT NOT NULL, label_id TEXT NOT NULL, "
+                "PRIMARY KEY (id, prompt_hash))"
+            )
+        return self._db
+
+    @staticmethod
+    def _prompt_hash(custom_prompt):
+        return hashlib.sha1((custom_prompt or '').encode('utf-8')).hexdigest()
+
+    def unprocessed(self, msg_ids, custom_prompt=None):
+        """
+        Returns the message IDs that have not been processed with custom_prompt yet,
+        in their original order.
+        """
+        prompt_hash = self._prompt_hash(custom_prompt)
+        done = set()
+        with self._lock:
+            db = self._connection()
+            for start in range(0, len(msg_ids), SQLITE_MAX_VARIABLES):
+                chunk = msg_ids[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = db.execute(
+                    f"SELECT id FROM processed_messages WHERE prompt_hash = ? AND id IN ({placeholders})",
+                    [prompt_hash] + chunk
+                )
+                done.update(row[0] for row in rows)
+        return [msg_id for msg_id in msg_ids if msg_id not in done]
+
+    def add(self, records, custom_prompt=None):
+        """
+        Marks messages as processed with custom_prompt from (msg_id, label_id) tuples.
+        """
+        prompt_hash = self._prompt_hash(custom_prompt)
+        with self._lock:
+            db = self._connection()
+            db.executemany(
+                "INSERT OR REPLACE INTO processed_messages VALUES (?, ?, ?)",
+                [(msg_id, prompt_hash, label_id) for msg_id, label_id in records]
+            )
+            db.commit()
+
+processed_messages = ProcessedMessages(PROCESSED_DB_PATH)
+
+async def classify_email(client, semaphore, prompt):
+    """
+    Uses OpenAI to classify an email from its classification prompt.
+    The semaphore caps how many requests are sent concurrently.
+    Returns None if the request fails or the output is not a category.
+    """
     try:
-        response = openai.Completion.create(
-            engine="text-davinci-003",
-            prompt=prompt,
-            max_tokens=20,
-            temperature=0.0,
-            n=1,
-            stop=["\n"]
-        )
-        category = response.choices[0].text.strip()
-        allowed_categories = ['Work', 'Personal', 'Promotions', 'Social', 'Updates']
-        if category not in allowed_categories:
-            category = 'Other'
+        async with semaphore:
+            response = await client.chat.completions.create(**completion_params(prompt))
     except Exception as e:
         print(f"Error classifying email: {e}")
-        category = 'Other'
-    return category
+        return None
+    return parse_category(response.choices[0].message.content)
 
-def get_or_create_label(service, label_name):
+async def embed_emails(client, semaphore, emails):
     """
-    Retrieves the Gmail label ID for a given label name or creates it if it doesn't exist.
+    Embeds (subject, snippet) pairs with as few embeddings requests as possible.
+    Returns a float32 matrix with one row per email.
+    """
+    inputs = [f"{subject}\n{snippet}" for subject, snippet in emails]
+    rows = []
+    for start in range(0, len(inputs), EMBEDDING_BATCH_SIZE):
+        async with semaphore:
+            response = await client.embeddings.create(
+                model=EMBEDDING_MODEL, input=inputs[start:start + EMBEDDING_BATCH_SIZE]
+            )
+        rows.extend(item.embedding for item in response.data)
+    return np.array(rows, dtype=np.float32)
+
+async def classify_unique_emails(client, semaphore, emails, custom_prompt=None):
+    """
+    Classifies distinct (subject, snippet) pairs concurrently, reusing cached
+    classifications: exact prompt matches first, then, if enabled, semantically
+    similar emails found with one batched embeddings request.
+    API failures map to None, so they are neither cached nor labeled.
+    Returns a dict mapping each pair to its category.
+    """
+    prompts = {
+        email: build_classification_prompt(email[0], email[1], custom_prompt)
+        for email in emails
+    }
+    cached = await asyncio.to_thread(classification_cache.get_many, list(prompts.values()))
+    results = dict(zip(prompts, cached))
+    pending = [email for email, category in results.items() if category is None]
+
+    vectors = None
+    if SEMANTIC_CACHE_ENABLED and pending:
+        try:
+            vectors = await embed_emails(client, semaphore, pending)
+        except Exception as e:
+            print(f"Error embedding emails: {e}")
+        else:
+            similar = await asyncio.to_thread(classification_cache.get_similar, custom_prompt, vectors)
+            misses = [index for index, category in enumerate(similar) if category is None]
+            for email, category in zip(pending, similar):
+                if category is not None:
+                    results[email] = category
+            pending = [pending[index] for index in misses]
+            vectors = vectors[misses]
+
+    categories = await asyncio.gather(*(
+        classify_email(client, semaphore, prompts[email]) for email in pending
+    ))
+    new_entries = []
+    classified = []
+    for index, (email, category) in enumerate(zip(pending, categories)):
+        results[email] = category
+        if category is None:
+            continue
+        new_entries.append((prompts[email], category))
+        classified.append(index)
+    if new_entries:
+        await asyncio.to_thread(classification_cache.put_many, new_entries)
+    if vectors is not None and classified:
+        await asyncio.to_thread(
+            classification_cache.put_similar_many, custom_prompt, vectors[classified],
+            [categories[index] for index in classified]
+        )
+    return results
+
+async def classify_emails(client, semaphore, emails, custom_prompt=None, in_flight=None):
+    """
+    Classifies a list of (subject, snippet) pairs concurrently.
+    Identical pairs (e.g. repeated notifications) are only sent once per run: in_flight maps
+    each pair already being classified, by this or another page, to a future of its category.
+    Returns the categories in the same order as the input.
+    """
+    if in_flight is None:
+        in_flight = {}
+    loop = asyncio.get_running_loop()
+    owned = [email for email in dict.fromkeys(emails) if email not in in_flight]
+    for email in owned:
+        in_flight[email] = loop.create_future()
+    try:
+        results = await classify_unique_emails(client, semaphore, owned, custom_prompt)
+    except BaseException:
+        for email in owned:
+            in_flight[email].cancel()
+        raise
+    for email in owned:
+        in_flight[email].set_result(results[email])
+    return [await in_flight[email] for email in emails]
+
+async def classify_messages(service, query, custom_prompt=None, limit=None):
+    """
+    Streams the messages matching a query through classification:
+      - A producer lists one page of messages at a time, drops the ones processed by an
+        earlier run and fetches the details of the rest, stopping after limit messages.
+      - Each page is classified as soon as it arrives, while the next page is being fetched.
+    The Gmail calls run one at a time in a worker thread, since the service is not thread-safe.
+    Returns a list of (msg_id, subject, category) tuples; category is None
+    when the classification failed.
+    """
+    pages_queue = asyncio.Queue(maxsize=2)
+    # Classifications shared across pages, so a repeated email is only sent once per run.
+    in_flight = {}
+
+    def fetch_page_details(page, remaining):
+        # Runs in one worker thread: drops processed messages (a SQLite query), applies the
+        # limit and fetches the details. Returns the number of new messages and their details.
+        msg_ids = processed_messages.unprocessed([msg['id'] for msg in page.get('messages', [])], custom_prompt)
+        if remaining is not None:
+            msg_ids = msg_ids[:remaining]
+        return len(msg_ids), get_messages_details(service, msg_ids) if msg_ids else []
+
+    async def produce():
+        # The end-of-pages marker is skipped on cancellation, when nobody reads the queue anymore.
+        try:
+            remaining = limit
+            list_request = service.users().messages().list(userId='me', q=query, maxResults=LIST_PAGE_SIZE)
+            while list_request is not None and remaining != 0:
+                page = await run_gmail_call(execute_request, list_request)
+                count, details = await run_gmail_call(fetch_page_details, page, remaining)
+                if remaining is not None:
+                    remaining -= count
+                if details:
+                    await pages_queue.put(details)
+                list_request = service.users().messages().list_next(list_request, page)
+        except Exception:
+            await pages_queue.put(None)
+            raise
+        await pages_queue.put(None)
+
+    async def classify_page(client, semaphore, details):
+        categories = await classify_emails(
+            client, semaphore, [(subject, snippet) for _, subject, snippet in details],
+            custom_prompt, in_flight
+        )
+        return [(msg_id, subject, category) for (msg_id, subject, _), category in zip(details, categories)]
+
+    semaphore = asyncio.Semaphore(CLASSIFY_CONCURRENCY)
+    async with openai.AsyncOpenAI(api_key=openai.api_key) as client:
+        producer = asyncio.create_task(produce())
+        pages = []
+        try:
+            while (details := await pages_queue.get()) is not None:
+                pages.append(asyncio.create_task(classify_page(client, semaphore, details)))
+            await producer
+            results = await asyncio.gather(*pages)
+        except BaseException:
+            # Wait for the cancelled tasks, so no Gmail call outlives the checked-out service.
+            producer.cancel()
+            for task in pages:
+                task.cancel()
+            await asyncio.gather(producer, *pages, return_exceptions=True)
+            raise
+    return [item for page in results for item in page]
+
+@retry_google
+def create_label(service, label_name):
+    """
+    Creates a Gmail label and returns its ID.
+    If the label already exists (HTTP 409), returns the ID of the existing label.
     """
-    results = service.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
-    for label in labels:
-        if label['name'].lower() == label_name.lower():
-            return label['id']
     label_body = {
         'name': label_name,
         'labelListVisibility': 'labelShow',
         'messageListVisibility': 'show'
     }
-    created_label = service.users().labels().create(userId='me', body=label_body).execute()
+    try:
+        created_label = service.users().labels().create(userId='me', body=label_body).execute()
+    except HttpError as e:
+        # A retried create may find the label made by an attempt that failed in transit.
+        if int(e.resp.status) != 409:
+            raise
+        results = service.users().labels().list(userId='me').execute()
+        for label in results.get('labels', []):
+            if label['name'].casefold() == label_name.casefold():
+                return label['id']
+        raise
     return created_label['id']
 
-def add_label_to_message(service, msg_id, label_id):
+class LabelCache:
     """
-    Adds a specified label to a Gmail message.
+    Maps Gmail label names (case-insensitively, via casefold) to label IDs for the duration of a run.
+    Labels are listed once up front; the API is only called again to create missing labels.
     """
-    body = {'addLabelIds': [label_id]}
-    service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
 
-def get_message_details(service, msg_id):
+    def __init__(self, service):
+        self.service = service
+        results = execute_request(service.users().labels().list(userId='me'))
+        self._by_name = {label['name'].casefold(): label['id'] for label in results.get('labels', [])}
+
+    def get_or_create(self, label_name):
+        """
+        Retrieves the label ID for a given label name, or creates it if it doesn't exist.
+        """
+        key = label_name.casefold()
+        label_id = self._by_name.get(key)
+        if label_id is None:
+            label_id = create_label(self.service, label_name)
+            self._by_name[key] = label_id
+        return label_id
+
+@retry_google
+def add_label_to_messages(service, msg_ids, label_id):
     """
-    Retrieves the subject and snippet for a given Gmail message ID.
+    Adds a specified label to many Gmail messages using batchModify,
+    at most GMAIL_MODIFY_BATCH_SIZE messages per call.
+    """
+    for start in range(0, len(msg_ids), GMAIL_MODIFY_BATCH_SIZE):
+        body = {'ids': msg_ids[start:start + GMAIL_MODIFY_BATCH_SIZE], 'addLabelIds': [label_id]}
+        service.users().messages().batchModify(userId='me', body=body).execute()
+
+def parse_message_details(message):
     """
-    message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    headers = message.get('payload', {}).get('headers', [])
-    subject = ""
-    for header in headers:
-        if header.get('name', '').lower() == 'subject':
-            subject = header.get('value', '')
-            break
+    Extracts the subject and snippet from a Gmail message resource.
+    """
+    headers = {
+        header.get('name', '').lower(): header.get('value', '')
+        for header in message.get('payload', {}).get('headers', [])
+    }
+    subject = headers.get('subject', '')
     snippet = message.get('snippet', '')
     return subject, snippet
 
+@retry_google
+def execute_details_batch(service, msg_ids, details):
+    """
+    Fetches the messages in msg_ids that are not in details yet with one batched
+    request, storing (subject, snippet) per message ID (None if it cannot be fetched).
+    Raises the first quota error so a retry only refetches the messages that failed.
+    """
+    quota_errors = []
+
+    def handle_response(request_id, response, exception):
+        if exception is None:
+            details[request_id] = parse_message_details(response)
+        elif is_quota_error(exception):
+            quota_errors.append(exception)
+        else:
+            print(f"Error fetching message {request_id}: {exception}")
+            details[request_id] = None
+
+    batch = service.new_batch_http_request(callback=handle_response)
+    for msg_id in msg_ids:
+        if msg_id not in details:
+            batch.add(
+                service.users().messages().get(
+                    userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject'],
+                    fields=MESSAGE_DETAIL_FIELDS
+                ),
+                request_id=msg_id
+            )
+    batch.execute()
+    if quota_errors:
+        raise quota_errors[0]
+
+def get_messages_details(service, msg_ids):
+    """
+    Retrieves the subject and snippet for several Gmail message IDs using batched
+    requests, so each batch costs a single HTTP round-trip instead of one per message.
+    Returns a list of (msg_id, subject, snippet) tuples in the order of msg_ids;
+    messages that could not be fetched are skipped.
+    """
+    details = {}
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        execute_details_batch(service, msg_ids[start:start + GMAIL_BATCH_SIZE], details)
+    return [(msg_id,) + details[msg_id] for msg_id in msg_ids if details.get(msg_id)]
+
 def get_email_content(service, msg_id):
     """
     Retrieves the full email content (subject and body) for a given message ID.
     Attempts to decode plain text content.
     """
-    message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    headers = message.get('payload', {}).get('headers', [])
-    subject = ""
-    for header in headers:
-        if header.get('name', '').lower() == 'subject':
-            subject = header.get('value', '')
-            break
+    message = execute_request(service.users().messages().get(userId='me', id=msg_id, format='full'))
+    headers = {
+        header.get('name', '').lower(): header.get('value', '')
+        for header in message.get('payload', {}).get('headers', [])
+    }
+    subject = headers.get('subject', '')
 
     body = ""
     payload = message.get('payload', {})
@@ -141,85 +719,245 @@ def get_email_content(service, msg_id):
 
     return subject, body
 
-def run_gmail_agent(custom_prompt=None):
+def apply_labels(service, classified, custom_prompt=None):
+    """
+    Creates (or retrieves) the Gmail label for each category and applies it to the
+    classified messages with one batchModify per label, recording them as processed
+    with custom_prompt.
+    Messages whose classification failed are skipped, so a later run retries them.
+    """
+    labels = LabelCache(service)
+    by_label = defaultdict(list)
+    for msg_id, _, category in classified:
+        if category is None:
+            continue
+        by_label[labels.get_or_create(category)].append(msg_id)
+    for label_id, msg_ids in by_label.items():
+        add_label_to_messages(service, msg_ids, label_id)
+        processed_messages.add([(msg_id, label_id) for msg_id in msg_ids], custom_prompt)
+
+def summarize_run(classified, limit):
+    """
+    Builds a short report of a run: the number of emails per category and the first
+    few subjects. The report is flashed into the cookie session, so it must stay small.
+    """
+    counts = defaultdict(int)
+    failed = 0
+    for _, _, category in classified:
+        if category is None:
+            failed += 1
+        else:
+            counts[category] += 1
+    report = [
+        f"Labeled {len(classified) - failed} email(s): "
+        + ", ".join(f"{category}: {count}" for category, count in sorted(counts.items()))
+    ]
+    if failed:
+        report.append(f"{failed} email(s) could not be classified and will be retried on the next run.")
+    report.extend(
+        f"Email '{subject[:80]}' classified as {category or 'unknown (classification failed)'}."
+        for _, subject, category in classified[:SUMMARY_SUBJECTS]
+    )
+    if len(classified) > SUMMARY_SUBJECTS:
+        report.append(f"... and {len(classified) - SUMMARY_SUBJECTS} more.")
+    if len(classified) == limit:
+        report.append(f"Stopped after {limit} emails; run again to process the rest.")
+    return report
+
+async def run_gmail_agent(custom_prompt=None):
     """
     Executes the Gmail AI Agent:
       - Authenticates with Gmail.
-      - Retrieves unread emails.
-      - Uses OpenAI (with a custom prompt, if provided) to classify each email.
+      - Retrieves unread emails page by page, skipping those labeled by an earlier run,
+        up to RUN_MAX_MESSAGES per run.
+      - Uses OpenAI (with a custom prompt, if provided) to classify the emails concurrently,
+        overlapping classification of one page with fetching the next.
       - Creates (or retrieves) Gmail labels.
       - Applies labels to the emails.
+    Blocking Gmail calls run in worker threads so other requests keep being served.
+    Returns a short summary string.
+    """
+    query = "is:unread"
+    async with gmail_service() as service:
+        classified = await classify_messages(service, query, custom_prompt, RUN_MAX_MESSAGES)
+        if not classified:
+            return "No new messages found."
+        await run_gmail_call(apply_labels, service, classified, custom_prompt)
+    return "\n".join(summarize_run(classified, RUN_MAX_MESSAGES))
+
+def chunk_batch_lines(lines):
+    """
+    Splits Batch API request lines into input files within BATCH_MAX_REQUESTS
+    lines and BATCH_MAX_BYTES each.
+    """
+    chunk, size = [], 0
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if chunk and (len(chunk) >= BATCH_MAX_REQUESTS or size + line_size > BATCH_MAX_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(line)
+        size += line_size
+    if chunk:
+        yield chunk
+
+def wait_for_batch_job(client, job):
+    """
+    Polls an OpenAI batch job with exponential back-off until it reaches a final status.
+    """
+    delay = BATCH_POLL_INITIAL
+    while job.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        time.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX)
+        job = client.batches.retrieve(job.id)
+    return job
+
+def run_gmail_agent_batch(custom_prompt=None, query="in:inbox"):
+    """
+    Bulk variant of run_gmail_agent for relabeling a whole mailbox:
+      - Retrieves every message matching the query.
+      - Submits the classifications as OpenAI Batch API jobs (split to stay within the
+        per-file limits), which are cheaper than real-time calls but may take up to
+        24 hours to complete.
+      - Polls the jobs, then applies labels with one batchModify per category
+        and records the messages as processed.
+    Messages whose classification failed are reported and left unlabeled.
     Returns a report string.
     """
     service = gmail_authenticate()
-    query = "is:unread"
-    results = service.users().messages().list(userId='me', q=query, maxResults=10).execute()
-    messages = results.get('messages', [])
+    msg_ids = []
+    list_request = service.users().messages().list(userId='me', q=query, maxResults=500)
+    while list_request is not None:
+        page = execute_request(list_request)
+        msg_ids.extend(msg['id'] for msg in page.get('messages', []))
+        list_request = service.users().messages().list_next(list_request, page)
+    details = get_messages_details(service, msg_ids)
+    if not details:
+        return "No messages found."
+
+    subjects = {msg_id: subject for msg_id, subject, _ in details}
+    lines = [
+        json.dumps({
+            'custom_id': msg_id,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': completion_params(build_classification_prompt(subject, snippet, custom_prompt))
+        })
+        for msg_id, subject, snippet in details
+    ]
+
+    client = openai.OpenAI(api_key=openai.api_key)
+    jobs = []
+    for chunk in chunk_batch_lines(lines):
+        batch_file = client.files.create(
+            file=('classify.jsonl', "\n".join(chunk).encode('utf-8')),
+            purpose="batch"
+        )
+        jobs.append(client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        ))
+
     report = []
-    if not messages:
-        report.append("No messages found.")
-        return "\n".join(report)
-    for msg in messages:
-        msg_id = msg['id']
-        subject, snippet = get_message_details(service, msg_id)
-        category = classify_email(subject, snippet, custom_prompt)
-        label_id = get_or_create_label(service, category)
-        add_label_to_message(service, msg_id, label_id)
-        report.append(f"Email '{subject}' classified as {category} and labeled.")
+    categories = {}
+    errors = {}
+    for job in jobs:
+        job = wait_for_batch_job(client, job)
+        if job.status != 'completed':
+            # Expired or cancelled jobs may still carry partial results.
+            report.append(f"Batch job {job.id} finished with status '{job.status}'.")
+        if job.output_file_id:
+            for line in client.files.content(job.output_file_id).text.splitlines():
+                result = json.loads(line)
+                response = result.get('response') or {}
+                if response.get('status_code') == 200:
+                    content = response['body']['choices'][0]['message']['content']
+                    category = parse_category(content)
+                    if category is None:
+                        errors[result['custom_id']] = f"unexpected output {content!r}"
+                    else:
+                        categories[result['custom_id']] = category
+                else:
+                    errors[result['custom_id']] = result.get('error') or response.get('body')
+        # Failed requests are written to a separate error file.
+        if job.error_file_id:
+            for line in client.files.content(job.error_file_id).text.splitlines():
+                result = json.loads(line)
+                errors[result['custom_id']] = result.get('error') or (result.get('response') or {}).get('body')
+
+    by_category = defaultdict(list)
+    for msg_id, category in categories.items():
+        by_category[category].append(msg_id)
+    labels = LabelCache(service)
+    for category, ids in by_category.items():
+        label_id = labels.get_or_create(category)
+        add_label_to_messages(service, ids, label_id)
+        processed_messages.add([(msg_id, label_id) for msg_id in ids], custom_prompt)
+        report.extend(f"Email '{subjects.get(msg_id, '')}' classified as {category} and labeled." for msg_id in ids)
+    for msg_id in subjects:
+        if msg_id not in categories:
+            error = errors.get(msg_id, "no result returned")
+            report.append(f"Email '{subjects[msg_id]}' ({msg_id}) could not be classified: {error}")
     return "\n".join(report)
 
 # -------------------------
-# Flask Routes
+# Routes
 # -------------------------
 
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return await render_template('index.html')
 
 @app.route('/run', methods=['POST'])
-def run():
-    custom_prompt = request.form.get('custom_prompt', None)
+async def run():
+    form = await request.form
+    custom_prompt = form.get('custom_prompt', None)
     try:
-        result = run_gmail_agent(custom_prompt)
-        flash(result, 'success')
+        result = await run_gmail_agent(custom_prompt)
+        await flash(result, 'success')
     except Exception as e:
-        flash(f"Error: {str(e)}", 'danger')
+        await flash(f"Error: {str(e)}", 'danger')
     return redirect(url_for('index'))
 
 @app.route('/folders')
-def folders():
+async def folders():
     """
     Lists all Gmail labels (folders).
     """
-    service = gmail_authenticate()
-    results = service.users().labels().list(userId='me').execute()
+    async with gmail_service() as service:
+        results = await run_gmail_call(execute_request, service.users().labels().list(userId='me'))
     labels = results.get('labels', [])
-    return render_template('folders.html', labels=labels)
+    return await render_template('folders.html', labels=labels)
 
 @app.route('/folder/<label_id>')
-def folder(label_id):
+async def folder(label_id):
     """
     Displays emails contained within a specific Gmail label.
     """
-    service = gmail_authenticate()
-    results = service.users().messages().list(userId='me', labelIds=[label_id]).execute()
-    messages = results.get('messages', [])
-    email_details = []
-    for msg in messages:
-        msg_id = msg['id']
-        subject, snippet = get_message_details(service, msg_id)
-        email_details.append({'id': msg_id, 'subject': subject, 'snippet': snippet})
-    return render_template('folder.html', emails=email_details, label_id=label_id)
+    async with gmail_service() as service:
+        results = await run_gmail_call(
+            execute_request, service.users().messages().list(userId='me', labelIds=[label_id])
+        )
+        messages = results.get('messages', [])
+        msg_ids = [msg['id'] for msg in messages]
+        details = await run_gmail_call(get_messages_details, service, msg_ids)
+    email_details = [
+        {'id': msg_id, 'subject': subject, 'snippet': snippet}
+        for msg_id, subject, snippet in details
+    ]
+    return await render_template('folder.html', emails=email_details, label_id=label_id)
 
 @app.route('/email/<msg_id>')
-def view_email(msg_id):
+async def view_email(msg_id):
     """
     Instead of displaying the email content, this route creates a link
     that, when clicked, opens the email in Gmail's web interface.
     """
     # Construct the Gmail URL. You can use "#all" or "#inbox" depending on your needs.
     gmail_link = f"https://mail.google.com/mail/u/0/#all/{msg_id}"
-    return render_template('email.html', gmail_link=gmail_link)
+    return await render_template('email.html', gmail_link=gmail_link)
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Equivalent to: uvicorn app:app --workers 1 (uvloop is used when installed).
+    uvicorn.run('app:app', workers=1)
@@ -16,11 +16,17 @@ in the same directory, and replace 'YOUR_OPENAI_API_KEY' below.
 """
 
 import os
+import re
+import functools
 import openai  # Use the standard openai package
+import tiktoken
+from collections import defaultdict
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # Set your OpenAI API key
 #openai.api_key = 'Enter code'  Replace with your actual OpenAI API key
@@ -28,6 +34,67 @@ from googleapiclient.discovery import build
 # If modifying these SCOPES, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Chat model used for classification; it answers with a single category token.
+CLASSIFY_MODEL = "gpt-4o-mini"
+
+# A custom prompt mentioning "only", "work" and "social" (in any order) selects two-folder mode.
+TWO_FOLDER_PATTERN = re.compile(r'^(?=.*only)(?=.*work)(?=.*social)', re.IGNORECASE | re.DOTALL)
+TWO_FOLDER_CATEGORIES = ("Work", "Social")
+DEFAULT_CATEGORIES = ("Work", "Personal", "Promotions", "Social", "Updates")
+
+# Gmail accepts up to 100 calls per batch, but recommends staying at or below 50.
+GMAIL_BATCH_SIZE = 50
+# Partial response for message listings: only the Subject header and the snippet are used.
+MESSAGE_DETAIL_FIELDS = 'snippet,payload/headers'
+# Gmail's batchModify accepts at most 1000 message IDs per call.
+GMAIL_MODIFY_BATCH_SIZE = 1000
+# Gmail API responses worth retrying with exponential back-off.
+RETRYABLE_STATUSES = {429, 500, 502, 503}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def is_quota_error(exc):
+    """
+    Return True if a Gmail API error is caused by rate limiting or a transient
+    server failure, i.e. the request is worth retrying.
+    """
+    if not isinstance(exc, HttpError):
+        return False
+    status = int(exc.resp.status)
+    if status in RETRYABLE_STATUSES:
+        return True
+    # 403 is also used for permission errors, so only retry the rate-limit reasons.
+    content = exc.content or b''
+    return status == 403 and any(reason.encode() in content for reason in RATE_LIMIT_REASONS)
+
+
+# Retries Gmail API calls on quota errors, sleeping min(2**n + jitter, 64) seconds.
+retry_google = retry(
+    retry=retry_if_exception(is_quota_error),
+    wait=wait_exponential_jitter(initial=1, max=64),
+    stop=stop_after_attempt(7),
+    reraise=True
+)
+
+
+@retry_google
+def execute_request(api_request):
+    """
+    Execute a single Gmail API request, retrying on quota errors.
+    """
+    return api_request.execute()
+
+
+def save_credentials(creds):
+    """
+    Write refreshed credentials to token.json atomically, so a concurrent reader
+    never sees a partially written file.
+    """
+    tmp_path = 'token.json.tmp'
+    with open(tmp_path, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(tmp_path, 'token.json')
+
 
 def gmail_authenticate():
     """
@@ -46,165 +113,227 @@ def gmail_authenticate():
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run.
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    service = build('gmail', 'v1', credentials=creds)
+        save_credentials(creds)
+    service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
     return service
 
-def classify_email(subject, snippet, custom_prompt=None):
+@functools.lru_cache(maxsize=None)
+def category_tokens(categories):
     """
-    Use OpenAI to classify an email based on its subject and snippet.
-    If a custom prompt is provided that instructs to only use two folders,
-    the allowed categories are set to ["Work", "Social"]; otherwise, the default
-    allowed categories are: Work, Personal, Promotions, Social, or Updates.
+    Return {token ID: category} mapping the first token of each category name,
+    so a single output token identifies the category.
+    """
+    encoding = tiktoken.encoding_for_model(CLASSIFY_MODEL)
+    return {encoding.encode(category)[0]: category for category in categories}
+
+def is_two_folder_mode(custom_prompt):
     """
-    # Determine allowed categories based on the custom prompt.
-    if custom_prompt and "only" in custom_prompt.lower() and \
-       "work" in custom_prompt.lower() and "social" in custom_prompt.lower():
-        allowed_categories = ["Work", "Social"]
-        prompt = (
-            f"{custom_prompt}\nAllowed categories: Work, Social.\n"
+    Return True if the custom prompt instructs to only use the Work and Social folders.
+    """
+    return bool(custom_prompt and TWO_FOLDER_PATTERN.search(custom_prompt))
+
+def build_prompt_template(custom_prompt, two_folder_mode):
+    """
+    Build the classification prompt once per run, with {subject} and {snippet}
+    placeholders to be filled in per email with str.format.
+    """
+    if two_folder_mode:
+        # Escape braces so the user's prompt survives str.format.
+        escaped_prompt = custom_prompt.replace('{', '{{').replace('}', '}}')
+        return (
+            f"{escaped_prompt}\nAllowed categories: Work, Social.\n"
             "Return only the word 'Work' or 'Social' as the answer (no extra text).\n\n"
-            f"Email Subject: {subject}\nEmail Snippet: {snippet}\n\nCategory:"
-        )
-    else:
-        allowed_categories = ["Work", "Personal", "Promotions", "Social", "Updates"]
-        prompt = (
-            "Below are some examples of email classifications:\n\n"
-            "Example 1:\n"
-            "Email Subject: Project Deadline Reminder\n"
-            "Email Snippet: Don't forget the deadline for the project is tomorrow.\n"
-            "Category: Work\n\n"
-            "Example 2:\n"
-            "Email Subject: Family Reunion Invitation\n"
-            "Email Snippet: Looking forward to our family reunion this weekend!\n"
-            "Category: Personal\n\n"
-            "Example 3:\n"
-            "Email Subject: 50% Off Sale on Shoes!\n"
-            "Email Snippet: Hurry up! Our biggest sale of the year is live now.\n"
-            "Category: Promotions\n\n"
-            "Example 4:\n"
-            "Email Subject: New Friend Request\n"
-            "Email Snippet: John Doe sent you a friend request on SocialNet.\n"
-            "Category: Social\n\n"
-            "Example 5:\n"
-            "Email Subject: Account Update Notice\n"
-            "Email Snippet: There is an update on your account settings.\n"
-            "Category: Updates\n\n"
-            "Now, classify the following email into one of these categories: "
-            "Work, Personal, Promotions, Social, or Updates.\n\n"
-            f"Email Subject: {subject}\nEmail Snippet: {snippet}\nCategory:"
+            "Email Subject: {subject}\nEmail Snippet: {snippet}\n\nCategory:"
         )
+    return (
+        "Below are some examples of email classifications:\n\n"
+        "Example 1:\n"
+        "Email Subject: Project Deadline Reminder\n"
+        "Email Snippet: Don't forget the deadline for the project is tomorrow.\n"
+        "Category: Work\n\n"
+        "Example 2:\n"
+        "Email Subject: Family Reunion Invitation\n"
+        "Email Snippet: Looking forward to our family reunion this weekend!\n"
+        "Category: Personal\n\n"
+        "Example 3:\n"
+        "Email Subject: 50% Off Sale on Shoes!\n"
+        "Email Snippet: Hurry up! Our biggest sale of the year is live now.\n"
+        "Category: Promotions\n\n"
+        "Example 4:\n"
+        "Email Subject: New Friend Request\n"
+        "Email Snippet: John Doe sent you a friend request on SocialNet.\n"
+        "Category: Social\n\n"
+        "Example 5:\n"
+        "Email Subject: Account Update Notice\n"
+        "Email Snippet: There is an update on your account settings.\n"
+        "Category: Updates\n\n"
+        "Now, classify the following email into one of these categories: "
+        "Work, Personal, Promotions, Social, or Updates.\n\n"
+        "Email Subject: {subject}\nEmail Snippet: {snippet}\nCategory:"
+    )
+
+def classify_email(client, subject, snippet, two_folder_mode, prompt_template):
+    """
+    Use OpenAI to classify an email based on its subject and snippet.
+    In two-folder mode the allowed categories are ("Work", "Social"); otherwise, the default
+    allowed categories are: Work, Personal, Promotions, Social, or Updates.
+    prompt_template comes from build_prompt_template.
+    """
+    allowed_categories = TWO_FOLDER_CATEGORIES if two_folder_mode else DEFAULT_CATEGORIES
+    prompt = prompt_template.format(subject=subject, snippet=snippet)
     # Debug: print the prompt so you can verify it.
     print("DEBUG: Prompt sent to API:")
     print(prompt)
     
     try:
-        response = openai.Completion.create(
-            engine="text-davinci-003",
-            prompt=prompt,
-            max_tokens=20,
+        tokens = category_tokens(allowed_categories)
+        response = client.chat.completions.create(
+            model=CLASSIFY_MODEL,
+            messages=[{'role': 'user', 'content': prompt}],
+            max_tokens=1,
             temperature=0.0,
-            n=1,
-            stop=["\n"]
+            # Restrict the single output token to the allowed categories.
+            logit_bias={str(token): 100 for token in tokens}
         )
-        raw_category = response.choices[0].text.strip()
+        raw_category = response.choices[0].message.content.strip()
         print(f"DEBUG: Raw classification result: '{raw_category}'")
-        
-        # If the response is "Other" (or doesn't match allowed categories), force a fallback.
-        if raw_category.lower() == "other" or not any(cat.lower() in raw_category.lower() for cat in allowed_categories):
-            print("DEBUG: Response did not match allowed categories, applying fallback heuristic.")
-            # For two-folder mode, decide based on subject keywords.
-            if allowed_categories == ["Work", "Social"]:
-                work_keywords = ['meeting', 'deadline', 'project', 'schedule', 'report']
-                if any(word in subject.lower() for word in work_keywords):
-                    return "Work"
-                else:
-                    return "Social"
-            else:
-                # For the default mode, choose "Updates" as a fallback.
-                return "Updates"
-        
-        # Otherwise, try mapping the response to one of the allowed categories.
-        if allowed_categories == ["Work", "Social"]:
-            normalized = raw_category.lower()
-            if "work" in normalized:
-                return "Work"
-            elif "social" in normalized:
-                return "Social"
-            else:
-                # Fallback: use subject heuristics.
-                work_keywords = ['meeting', 'deadline', 'project', 'schedule', 'report']
-                if any(word in subject.lower() for word in work_keywords):
-                    return "Work"
-                return "Social"
-        else:
-            mapping = {
-                'work': 'Work',
-                'work-related': 'Work',
-                'personal': 'Personal',
-                'promotional': 'Promotions',
-                'promo': 'Promotions',
-                'social': 'Social',
-                'update': 'Updates',
-                'updates': 'Updates'
-            }
-            normalized = raw_category.lower()
-            for key, value in mapping.items():
-                if key in normalized:
-                    return value
-            if raw_category in allowed_categories:
-                return raw_category
-            return 'Updates'  # Fallback for the default set
-
+        encoded = tiktoken.encoding_for_model(CLASSIFY_MODEL).encode(raw_category)
+        if encoded and encoded[0] in tokens:
+            return tokens[encoded[0]]
+        print("DEBUG: Response did not match allowed categories, applying fallback heuristic.")
     except Exception as e:
         print(f"Error classifying email: {e}")
-        return 'Updates'
 
-def get_or_create_label(service, label_name):
+    # Fallback heuristic: for two-folder mode, decide based on subject keywords.
+    if two_folder_mode:
+        work_keywords = ['meeting', 'deadline', 'project', 'schedule', 'report']
+        if any(word in subject.lower() for word in work_keywords):
+            return "Work"
+        return "Social"
+    # For the default mode, choose "Updates" as a fallback.
+    return 'Updates'
+
+@retry_google
+def create_label(service, label_name):
     """
-    Retrieve the Gmail label ID for a given label name, or create it if it doesn't exist.
+    Create a Gmail label and return its ID.
+    If the label already exists (HTTP 409), return the ID of the existing label.
     """
-    results = service.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
-    for label in labels:
-        if label['name'].lower() == label_name.lower():
-            return label['id']
-    # If label not found, create it.
     label_body = {
         'name': label_name,
         'labelListVisibility': 'labelShow',
         'messageListVisibility': 'show'
     }
-    created_label = service.users().labels().create(userId='me', body=label_body).execute()
+    try:
+        created_label = service.users().labels().create(userId='me', body=label_body).execute()
+    except HttpError as e:
+        # A retried create may find the label made by an attempt that failed in transit.
+        if int(e.resp.status) != 409:
+            raise
+        results = service.users().labels().list(userId='me').execute()
+        for label in results.get('labels', []):
+            if label['name'].casefold() == label_name.casefold():
+                return label['id']
+        raise
     return created_label['id']
 
 
-def add_label_to_message(service, msg_id, label_id):
+class LabelCache:
+    """
+    Maps Gmail label names (case-insensitively, via casefold) to label IDs for the duration of a run.
+    Labels are listed once up front; the API is only called again to create missing labels.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        results = execute_request(service.users().labels().list(userId='me'))
+        self._by_name = {label['name'].casefold(): label['id'] for label in results.get('labels', [])}
+
+    def get_or_create(self, label_name):
+        """
+        Retrieve the label ID for a given label name, or create it if it doesn't exist.
+        """
+        key = label_name.casefold()
+        label_id = self._by_name.get(key)
+        if label_id is None:
+            label_id = create_label(self.service, label_name)
+            self._by_name[key] = label_id
+        return label_id
+
+
+@retry_google
+def add_label_to_messages(service, msg_ids, label_id):
     """
-    Add a specified label to a Gmail message.
+    Add a specified label to many Gmail messages using batchModify,
+    at most GMAIL_MODIFY_BATCH_SIZE messages per call.
     """
-    body = {'addLabelIds': [label_id]}
-    service.users().messages().modify(userId='me', id=msg_id, body=body).execute()
+    for start in range(0, len(msg_ids), GMAIL_MODIFY_BATCH_SIZE):
+        body = {'ids': msg_ids[start:start + GMAIL_MODIFY_BATCH_SIZE], 'addLabelIds': [label_id]}
+        service.users().messages().batchModify(userId='me', body=body).execute()
 
 
-def get_message_details(service, msg_id):
+def parse_message_details(message):
     """
-    Retrieve the subject and snippet for a given Gmail message ID.
+    Extract the subject and snippet from a Gmail message resource.
     """
-    message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-    headers = message.get('payload', {}).get('headers', [])
-    subject = ""
-    for header in headers:
-        if header.get('name', '').lower() == 'subject':
-            subject = header.get('value', '')
-            break
+    headers = {
+        header.get('name', '').lower(): header.get('value', '')
+        for header in message.get('payload', {}).get('headers', [])
+    }
+    subject = headers.get('subject', '')
     snippet = message.get('snippet', '')
     return subject, snippet
 
 
+@retry_google
+def execute_details_batch(service, msg_ids, details):
+    """
+    Fetch the messages in msg_ids that are not in details yet with one batched
+    request, storing (subject, snippet) per message ID (None if it cannot be fetched).
+    Raises the first quota error so a retry only refetches the messages that failed.
+    """
+    quota_errors = []
+
+    def handle_response(request_id, response, exception):
+        if exception is None:
+            details[request_id] = parse_message_details(response)
+        elif is_quota_error(exception):
+            quota_errors.append(exception)
+        else:
+            print(f"Error fetching message {request_id}: {exception}")
+            details[request_id] = None
+
+    batch = service.new_batch_http_request(callback=handle_response)
+    for msg_id in msg_ids:
+        if msg_id not in details:
+            batch.add(
+                service.users().messages().get(
+                    userId='me', id=msg_id, format='metadata', metadataHeaders=['Subject'],
+                    fields=MESSAGE_DETAIL_FIELDS
+                ),
+                request_id=msg_id
+            )
+    batch.execute()
+    if quota_errors:
+        raise quota_errors[0]
+
+
+def get_messages_details(service, msg_ids):
+    """
+    Retrieve the subject and snippet for several Gmail message IDs using batched
+    requests, so each batch costs a single HTTP round-trip instead of one per message.
+    Returns a list of (msg_id, subject, snippet) tuples in the order of msg_ids;
+    messages that could not be fetched are skipped.
+    """
+    details = {}
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        execute_details_batch(service, msg_ids[start:start + GMAIL_BATCH_SIZE], details)
+    return [(msg_id,) + details[msg_id] for msg_id in msg_ids if details.get(msg_id)]
+
+
 def main():
     service = gmail_authenticate()
+    client = openai.OpenAI(api_key=openai.api_key)
 
     # --- Customization Section ---
     # Set CUSTOM_PROMPT to instruct the agent to use only two folders.
@@ -214,22 +343,28 @@ def main():
     # -----------------------------
 
     query = "is:unread"
-    results = service.users().messages().list(userId='me', q=query, maxResults=10).execute()
+    results = execute_request(service.users().messages().list(userId='me', q=query, maxResults=10))
     messages = results.get('messages', [])
     if not messages:
         print("No messages found.")
         return
 
-    for msg in messages:
-        msg_id = msg['id']
-        subject, snippet = get_message_details(service, msg_id)
+    two_folder_mode = is_two_folder_mode(CUSTOM_PROMPT)
+    prompt_template = build_prompt_template(CUSTOM_PROMPT, two_folder_mode)
+    msg_ids = [msg['id'] for msg in messages]
+    by_category = defaultdict(list)
+    for msg_id, subject, snippet in get_messages_details(service, msg_ids):
         print(f"Processing email with subject: {subject}")
-        category = classify_email(subject, snippet, custom_prompt=CUSTOM_PROMPT)
-        print(f"Classified as: {category}")
-        # Get (or create) the label for this category and add it to the message.
-        label_id = get_or_create_label(service, category)
-        add_label_to_message(service, msg_id, label_id)
-        print(f"Added label '{category}' to email.\n")
+        category = classify_email(client, subject, snippet, two_folder_mode, prompt_template)
+        print(f"Classified as: {category}\n")
+        by_category[category].append(msg_id)
+
+    # Get (or create) the label for each category and add it to all of its messages at once.
+    labels = LabelCache(service)
+    for category, ids in by_category.items():
+        label_id = labels.get_or_create(category)
+        add_label_to_messages(service, ids, label_id)
+        print(f"Added label '{category}' to {len(ids)} email(s).")
 
 
 if __name__ == '__main__':